@@ -1,35 +1,222 @@
+import os
+import tempfile
+
 import pandas as pd
 import numpy as np
 import plotly.express as px
 import plotly.graph_objects as go
+import polars as pl
+import pyarrow as pa
+import pyarrow.parquet as pq
+from pyarrow import csv as pacsv
 import pycountry
 import streamlit as st
+from numba import njit
 
 st.set_page_config(layout="wide", page_title="Hydropower Dashboard")
 st.title("Hydropower Visualization Dashboard")
 st.markdown("Explore global hydropower capacity, distribution, and trends with interactive charts and filters.")
 
+# ===============================
+# Country name -> ISO3 lookup
+# ===============================
+COUNTRY_ALIASES = {
+    'Democratic Republic of the Congo': 'COD',
+    'Ivory Coast': 'CIV',
+    'North Korea': 'PRK',
+    'Russia': 'RUS',
+    'South Korea': 'KOR',
+    'Turkey': 'TUR',
+    'United States': 'USA',
+    'Vietnam': 'VNM',
+}
+
+ISO3 = {}
+for c in pycountry.countries:
+    for attr in ('alpha_2', 'alpha_3', 'name', 'official_name', 'common_name'):
+        value = getattr(c, attr, None)
+        if value:
+            ISO3[value.lower()] = c.alpha_3
+ISO3.update({name.lower(): code for name, code in COUNTRY_ALIASES.items()})
+
 # ===============================
 # Load and preprocess data
 # ===============================
-@st.cache_data
-def load_data():
-    df = pd.read_csv("GloHydroRes_vs1.csv")
-    df['year'] = pd.to_numeric(df['year'], errors='coerce')
-    df['capacity_mw'] = pd.to_numeric(df['capacity_mw'], errors='coerce')
-    df['res_vol_mcm'] = df['res_vol_km3'] * 1_000 if 'res_vol_km3' in df.columns else np.nan
-
-    def iso3(country_name):
-        try:
-            return pycountry.countries.lookup(country_name).alpha_3
-        except LookupError:
-            return None
-
-    df['Country_Iso3'] = df['country'].map(iso3)
+DATA_FILE = "GloHydroRes_vs1.csv"
+PARQUET_FILE = "GloHydroRes_vs1.parquet"
+COLUMNS = ['country', 'name', 'year', 'capacity_mw', 'plant_lat', 'plant_lon', 'res_vol_mcm', 'size_px', 'Country_Iso3']
+
+# Stamped into the Parquet metadata; bump it whenever build_parquet() changes
+# what it writes (columns, dtypes, categories, ISO3 mapping) so files written
+# by another version are rebuilt instead of reused.
+PARQUET_VERSION = b'1'
+VERSION_KEY = b'glohydrores_build'
+
+# Packed dtypes halve the bytes moved by every filter, group-by and
+# figure serialization downstream.
+CSV_TYPES = {
+    'country': pa.string(),
+    'name': pa.string(),
+    'year': pa.int16(),
+    'capacity_mw': pa.float32(),
+    'plant_lat': pa.float32(),
+    'plant_lon': pa.float32(),
+    'res_vol_km3': pa.float32(),
+}
+
+def build_parquet():
+    """Clean the raw CSV, persist it as a typed Parquet file and return it."""
+    table = pacsv.read_csv(
+        DATA_FILE,
+        read_options=pacsv.ReadOptions(use_threads=True),
+        convert_options=pacsv.ConvertOptions(
+            include_columns=list(CSV_TYPES),
+            include_missing_columns=True,
+            column_types=CSV_TYPES,
+            strings_can_be_null=True,
+        ),
+    )
+    df = table.to_pandas(types_mapper={pa.int16(): pd.Int16Dtype()}.get)
+    df['res_vol_mcm'] = df['res_vol_km3'] * 1_000
+
+    # Resolve each distinct country once, then gather by integer code; the
+    # trailing None is what a missing country's code (-1) indexes.
+    codes, uniques = pd.factorize(df['country'])
+    iso3_for_unique = np.array([ISO3.get(u.lower()) for u in uniques] + [None], dtype=object)
+    df['Country_Iso3'] = iso3_for_unique[codes]
     df = df.dropna(subset=['plant_lat', 'plant_lon'])
+
+    df['country'] = pd.Categorical(df['country'], categories=sorted(df['country'].dropna().unique()), ordered=True)
+    df['size_px'] = np.sqrt(df['res_vol_mcm'].to_numpy(dtype=np.float32) + 1.0)
+    df = df[COLUMNS].reset_index(drop=True)
+
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    table = table.replace_schema_metadata({**table.schema.metadata, VERSION_KEY: PARQUET_VERSION})
+
+    # Write next to the target and rename into place so a crash or a
+    # concurrent writer never leaves a truncated file behind. If the
+    # directory is read-only the app still runs off the in-memory frame.
+    tmp_path = None
+    try:
+        fd, tmp_path = tempfile.mkstemp(
+            prefix=os.path.basename(PARQUET_FILE) + '.',
+            suffix='.tmp',
+            dir=os.path.dirname(os.path.abspath(PARQUET_FILE)),
+        )
+        os.close(fd)
+        pq.write_table(table, tmp_path, compression='zstd')
+        os.replace(tmp_path, PARQUET_FILE)
+    except (OSError, pa.ArrowException):
+        if tmp_path is not None and os.path.exists(tmp_path):
+            os.remove(tmp_path)
     return df
 
-df = load_data()
+def parquet_is_stale():
+    if not os.path.exists(PARQUET_FILE) or os.path.getmtime(PARQUET_FILE) < os.path.getmtime(DATA_FILE):
+        return True
+    try:
+        schema = pq.read_schema(PARQUET_FILE)
+    except (OSError, pa.ArrowInvalid):
+        return True
+    return (schema.metadata or {}).get(VERSION_KEY) != PARQUET_VERSION
+
+# cache_resource hands every rerun the same parsed frame instead of
+# unpickling a fresh copy; treat `df` as read-only below. The source file's
+# mtime is the only cache key, so an edited CSV is picked up without ever
+# hashing a DataFrame, and only the current version is kept alive.
+@st.cache_resource(max_entries=1)
+def load_data(mtime):
+    if parquet_is_stale():
+        return build_parquet()
+    return pd.read_parquet(PARQUET_FILE, engine='pyarrow', columns=COLUMNS, memory_map=True)
+
+@st.cache_resource(max_entries=1)
+def load_polars(mtime, _df):
+    return pl.from_pandas(_df)
+
+data_mtime = os.path.getmtime(DATA_FILE)
+df = load_data(data_mtime)
+pl_df = load_polars(data_mtime, df)
+
+# ===============================
+# Cached aggregations and filters
+# ===============================
+# The frames above are fully determined by the source mtime, so key on that
+# and skip hashing the (underscore-prefixed) frame arguments entirely.
+@st.cache_data
+def total_capacity_by_country(mtime, _pl_df):
+    return (
+        _pl_df.lazy()
+        .drop_nulls('Country_Iso3')
+        .group_by('Country_Iso3')
+        .agg(pl.col('capacity_mw').cast(pl.Float64).sum())
+        .collect()
+        .to_pandas()
+    )
+
+@st.cache_data
+def sunburst_data(mtime, _pl_df):
+    return (
+        _pl_df.lazy()
+        .drop_nulls(['country', 'name'])
+        .group_by(['country', 'name'])
+        .agg(pl.col('capacity_mw').cast(pl.Float64).sum())
+        .sort(['country', 'name'])
+        .collect()
+        .to_pandas()
+    )
+
+@njit(cache=True)
+def group_sum(codes, vals, n):
+    sums = np.zeros(n, dtype=np.float64)
+    counts = np.zeros(n, dtype=np.int64)
+    for i in range(codes.size):
+        sums[codes[i]] += vals[i]
+        counts[codes[i]] += 1
+    return sums, counts
+
+@st.cache_data
+def yearly_by_country(mtime, _df):
+    df_ts = _df.dropna(subset=['year', 'country', 'capacity_mw'])
+    categories = df_ts['country'].cat.categories
+    year_codes, years = pd.factorize(df_ts['year'].to_numpy(dtype=np.int64), sort=True)
+
+    # Combine the two factorizations into one dense (country, year) code
+    codes = df_ts['country'].cat.codes.to_numpy(dtype=np.int64) * len(years) + year_codes
+    sums, counts = group_sum(codes, df_ts['capacity_mw'].to_numpy(dtype=np.float64), len(categories) * len(years))
+    present = np.flatnonzero(counts)
+    return pd.DataFrame({
+        'country': pd.Categorical.from_codes(present // len(years), categories),
+        'year': years[present % len(years)],
+        'capacity_mw': sums[present],
+    })
+
+# Slider filters run as a single fused Polars predicate; only the result
+# is converted to pandas for Plotly.
+@st.cache_data
+def filter_bubble(mtime, _pl_df, min_capacity, min_volume):
+    return (
+        _pl_df.lazy()
+        .filter((pl.col('res_vol_mcm') >= min_volume) & (pl.col('capacity_mw') >= min_capacity))
+        .collect()
+        .to_pandas()
+    )
+
+@st.cache_data
+def filter_anim(mtime, _pl_df, min_capacity, year_range):
+    return (
+        _pl_df.lazy()
+        .filter(
+            (pl.col('capacity_mw') >= min_capacity) &
+            pl.col('year').is_between(year_range[0], year_range[1])
+        )
+        .drop_nulls(['year', 'plant_lat', 'plant_lon', 'capacity_mw'])
+        # Ensure year is integer and sorted
+        .with_columns(pl.col('year').cast(pl.Int64))
+        .sort('year')
+        .collect()
+        .to_pandas()
+    )
 
 # ===============================
 # Sidebar controls
@@ -69,152 +256,235 @@ layout_style = dict(
     template='plotly_white',
     font=dict(family="Arial", size=14),
     title_font=dict(size=22),
+    # A stable uirevision lets Plotly.react diff reruns in place and keep
+    # the user's zoom/pan instead of redrawing each chart from scratch.
+    uirevision='constant',
 )
 
+# Figures are pure functions of their inputs. Small aggregated frames are
+# keyed on their contents; the full dataset is keyed on its source mtime plus
+# the slider values that filter it.
+FRAME_HASH = {pd.DataFrame: lambda d: (d.shape, pd.util.hash_pandas_object(d, index=True).values.tobytes())}
+
+def hierarchy(sun):
+    """Flatten per-plant (country, name) sums into ids/labels/parents/values."""
+    sun = sun.assign(capacity_mw=sun['capacity_mw'].astype(np.float64))
+    totals = sun.groupby('country', as_index=False, observed=True)['capacity_mw'].sum()
+    countries = totals['country'].tolist()
+    return dict(
+        ids=countries + (sun['country'].astype(str) + '/' + sun['name']).tolist(),
+        labels=countries + sun['name'].tolist(),
+        parents=[''] * len(countries) + sun['country'].tolist(),
+        # Kept as an ndarray so Plotly ships it as a base64 typed array
+        values=np.concatenate([totals['capacity_mw'].to_numpy(), sun['capacity_mw'].to_numpy()]),
+    )
+
 # ===============================
 # 1. Choropleth Map
 # ===============================
-st.markdown("---")
-st.subheader("1. Total Hydropower Capacity by Country")
-st.markdown("This map displays the total installed hydropower capacity aggregated by country.")
-
-country_cap = df.groupby('Country_Iso3', as_index=False)['capacity_mw'].sum()
-fig1 = px.choropleth(
-    country_cap,
-    locations='Country_Iso3',
-    color='capacity_mw',
-    color_continuous_scale='Cividis',
-    title='Total Hydropower Capacity by Country (MW)'
-)
-fig1.update_layout(**layout_style)
-st.plotly_chart(fig1, use_container_width=True)
+@st.cache_data(hash_funcs=FRAME_HASH)
+def build_choropleth(country_cap):
+    fig = px.choropleth(
+        country_cap,
+        locations='Country_Iso3',
+        color='capacity_mw',
+        color_continuous_scale='Cividis',
+        title='Total Hydropower Capacity by Country (MW)'
+    )
+    fig.update_layout(**layout_style)
+    return fig
+
+@st.fragment
+def choropleth_section(mtime, pl_df):
+    st.markdown("---")
+    st.subheader("1. Total Hydropower Capacity by Country")
+    st.markdown("This map displays the total installed hydropower capacity aggregated by country.")
+
+    country_cap = total_capacity_by_country(mtime, pl_df)
+    fig1 = build_choropleth(country_cap)
+    st.plotly_chart(fig1, use_container_width=True, key='fig1')
+
+choropleth_section(data_mtime, pl_df)
 
 # ===============================
 # 2. Bubble Map
 # ===============================
-st.markdown("---")
-st.subheader("2. Hydropower Plants by Reservoir Volume")
-st.markdown("This bubble map represents hydropower plants, with bubble size proportional to reservoir volume.")
-
-df_bubble = df[
-    (df['res_vol_mcm'] >= min_volume) &
-    (df['capacity_mw'] >= min_capacity)
-]
-
-fig2 = px.scatter_geo(
-    df_bubble,
-    lat='plant_lat',
-    lon='plant_lon',
-    size=np.sqrt(df_bubble['res_vol_mcm'] + 1),
-    hover_name='name',
-    hover_data={'capacity_mw': ':,.0f', 'res_vol_mcm': ':,.0f'},
-    projection='natural earth',
-    title='Bubble Map of Hydropower Plants (size ∝ reservoir volume)'
-)
-fig2.update_layout(**layout_style)
-st.plotly_chart(fig2, use_container_width=True)
+@st.cache_data
+def build_bubble_map(mtime, _pl_df, min_capacity, min_volume):
+    df_bubble = filter_bubble(mtime, _pl_df, min_capacity, min_volume)
+    fig = px.scatter_geo(
+        df_bubble,
+        lat='plant_lat',
+        lon='plant_lon',
+        size='size_px',
+        hover_name='name',
+        hover_data={'capacity_mw': ':,.0f', 'res_vol_mcm': ':,.0f', 'size_px': False},
+        projection='natural earth',
+        title='Bubble Map of Hydropower Plants (size ∝ reservoir volume)'
+    )
+    fig.update_layout(**layout_style)
+    return fig
+
+@st.fragment
+def bubble_map_section(mtime, pl_df, min_capacity, min_volume):
+    st.markdown("---")
+    st.subheader("2. Hydropower Plants by Reservoir Volume")
+    st.markdown("This bubble map represents hydropower plants, with bubble size proportional to reservoir volume.")
+
+    fig2 = build_bubble_map(mtime, pl_df, min_capacity, min_volume)
+    st.plotly_chart(fig2, use_container_width=True, key='fig2')
+
+bubble_map_section(data_mtime, pl_df, min_capacity, min_volume)
 
 # ===============================
 # 3. Sunburst Chart
 # ===============================
-st.markdown("---")
-st.subheader("3. Capacity Distribution by Country and Plant")
-st.markdown("The sunburst chart shows the hierarchy of countries and their individual plants based on installed capacity.")
+@st.cache_data(hash_funcs=FRAME_HASH)
+def build_sunburst(sun):
+    fig = go.Figure(go.Sunburst(**hierarchy(sun), branchvalues='total'))
+    fig.update_layout(title='Sunburst Chart of Hydropower Capacity', **layout_style, height=800)  # Enlarged
+    return fig
 
-sun = df.groupby(['country', 'name'], as_index=False)['capacity_mw'].sum()
-fig3 = px.sunburst(
-    sun,
-    path=['country','name'],
-    values='capacity_mw',
-    title='Sunburst Chart of Hydropower Capacity'
-)
-fig3.update_layout(**layout_style, height=800)  # Enlarged
-st.plotly_chart(fig3, use_container_width=True)
+@st.fragment
+def sunburst_section(mtime, pl_df):
+    st.markdown("---")
+    st.subheader("3. Capacity Distribution by Country and Plant")
+    st.markdown("The sunburst chart shows the hierarchy of countries and their individual plants based on installed capacity.")
+
+    sun = sunburst_data(mtime, pl_df)
+    fig3 = build_sunburst(sun)
+    st.plotly_chart(fig3, use_container_width=True, key='fig3')
+
+sunburst_section(data_mtime, pl_df)
 
 # ===============================
 # 4. Time Series
 # ===============================
-st.markdown("---")
-st.subheader("4. Installed Capacity by Country Over Time")
-st.markdown("Visualize how each selected country's hydropower capacity evolved over the years.")
+@st.cache_data(hash_funcs=FRAME_HASH)
+def build_timeseries(yearly_country, countries):
+    subset = yearly_country[yearly_country['country'].isin(countries)]
+    fig = px.line(
+        subset,
+        x='year',
+        y='capacity_mw',
+        color='country',
+        hover_name='country',
+        category_orders={'country': countries},
+        title='Installed Capacity by Country Over Time'
+    )
+    fig.update_traces(hovertemplate='<b>%{hovertext}</b><br>Year: %{x}<br>Capacity: %{y:.2f} MW')
+    fig.update_layout(
+        xaxis_title='Year',
+        yaxis_title='Installed Capacity (MW)',
+        hovermode='x unified',
+        **layout_style
+    )
+    return fig
 
-df_ts = df.dropna(subset=['year', 'country', 'capacity_mw'])
-yearly_country = df_ts.groupby(['country', 'year'], as_index=False)['capacity_mw'].sum()
+# The country picker lives inside the fragment, so changing it reruns
+# only this chart.
+@st.fragment
+def timeseries_section(mtime, df):
+    st.markdown("---")
+    st.subheader("4. Installed Capacity by Country Over Time")
+    st.markdown("Visualize how each selected country's hydropower capacity evolved over the years.")
 
-available_countries = sorted(yearly_country['country'].dropna().unique())
-default_candidates = ['China', 'United States']
-default_countries = [c for c in default_candidates if c in available_countries]
+    yearly_country = yearly_by_country(mtime, df)
 
-countries = st.multiselect(
-    "Select countries:",
-    available_countries,
-    default=default_countries
-)
+    # Only countries that survive the time-series null filter are offered
+    available_countries = list(yearly_country['country'].cat.remove_unused_categories().cat.categories)
+    default_candidates = ['China', 'United States']
+    default_countries = [c for c in default_candidates if c in available_countries]
 
-fig4 = go.Figure()
-for country in countries:
-    data = yearly_country[yearly_country['country'] == country]
-    fig4.add_trace(go.Scatter(
-        x=data['year'],
-        y=data['capacity_mw'],
-        mode='lines',
-        name=country,
-        hovertemplate='<b>%{text}</b><br>Year: %{x}<br>Capacity: %{y:.2f} MW',
-        text=[country]*len(data),
-    ))
-fig4.update_layout(
-    title='Installed Capacity by Country Over Time',
-    xaxis_title='Year',
-    yaxis_title='Installed Capacity (MW)',
-    hovermode='x unified',
-    **layout_style
-)
-st.plotly_chart(fig4, use_container_width=True)
+    countries = st.multiselect(
+        "Select countries:",
+        available_countries,
+        default=default_countries
+    )
+
+    fig4 = build_timeseries(yearly_country, countries)
+    st.plotly_chart(fig4, use_container_width=True, key='fig4')
+
+timeseries_section(data_mtime, df)
 
 # ===============================
 # 5. Animated Map
 # ===============================
-st.markdown("---")
-st.subheader("5. Evolution of Hydropower Facilities Over Time")
-st.markdown("An animated map showing the spatial and temporal development of hydropower facilities worldwide.")
-
-df_anim = df[
-    (df['capacity_mw'] >= min_capacity) &
-    (df['year'] >= selected_year_range[0]) &
-    (df['year'] <= selected_year_range[1])
-].dropna(subset=['year', 'plant_lat', 'plant_lon', 'capacity_mw'])
-
-# Ensure year is integer and sorted
-df_anim['year'] = df_anim['year'].astype(int)
-df_anim = df_anim.sort_values('year')
-
-fig5 = px.scatter_geo(
-    df_anim,
-    lat='plant_lat',
-    lon='plant_lon',
-    color='capacity_mw',
-    size='capacity_mw',
-    animation_frame='year',
-    projection='natural earth',
-    hover_name='name',
-    title='Evolution of Hydropower Facilities Over Time',
-    color_continuous_scale='Viridis'
-)
-fig5.update_layout(**layout_style)
-st.plotly_chart(fig5, use_container_width=True)
+@st.cache_data
+def build_animated_map(mtime, _pl_df, min_capacity, year_range):
+    df_anim = filter_anim(mtime, _pl_df, min_capacity, year_range)
+
+    # One marker per 1° x 1° cell per year instead of one per plant keeps
+    # the frame payload small for long year ranges.
+    grid = (
+        df_anim.assign(
+            lat_bin=np.floor(df_anim['plant_lat']).astype(int),
+            lon_bin=np.floor(df_anim['plant_lon']).astype(int),
+        )
+        .groupby(['year', 'lat_bin', 'lon_bin'], as_index=False)
+        .agg(capacity_mw=('capacity_mw', 'sum'), plants=('name', 'size'))
+    )
+    grid['lat'] = grid['lat_bin'] + 0.5
+    grid['lon'] = grid['lon_bin'] + 0.5
+
+    # Colour by capacity octile: one small integer per marker on a stepped
+    # scale. It stays a numeric colour so every frame keeps a single trace,
+    # which is what Plotly.animate needs to match frames to fig.data.
+    grid['capacity_bin'] = np.ceil(grid['capacity_mw'].rank(pct=True) * 8).astype('int8')
+    palette = px.colors.sample_colorscale('Viridis', 8)
+    octile_scale = [
+        [edge, color]
+        for i, color in enumerate(palette)
+        for edge in (i / 8, (i + 1) / 8)
+    ]
+
+    fig = px.scatter_geo(
+        grid,
+        lat='lat',
+        lon='lon',
+        color='capacity_bin',
+        size='capacity_mw',
+        animation_frame='year',
+        projection='natural earth',
+        hover_data={'plants': True, 'capacity_mw': ':,.0f', 'lat': False, 'lon': False},
+        labels={'capacity_bin': 'Capacity octile'},
+        range_color=(0.5, 8.5),
+        title='Evolution of Hydropower Facilities Over Time',
+        color_continuous_scale=octile_scale
+    )
+    fig.update_coloraxes(colorbar=dict(tickvals=list(range(1, 9)), ticktext=[f'Q{i}' for i in range(1, 9)]))
+    fig.update_traces(uirevision='constant')
+    fig.update_layout(**layout_style)
+    return fig
+
+@st.fragment
+def animated_map_section(mtime, pl_df, min_capacity, year_range):
+    st.markdown("---")
+    st.subheader("5. Evolution of Hydropower Facilities Over Time")
+    st.markdown("An animated map showing the spatial and temporal development of hydropower facilities worldwide.")
+
+    fig5 = build_animated_map(mtime, pl_df, min_capacity, year_range)
+    st.plotly_chart(fig5, use_container_width=True, key='fig5')
+
+animated_map_section(data_mtime, pl_df, min_capacity, selected_year_range)
 
 # ===============================
 # 6. Treemap
 # ===============================
-st.markdown("---")
-st.subheader("6. Treemap of Hydropower Capacity")
-st.markdown("The treemap illustrates the proportion of hydropower capacity by country and facility.")
+@st.cache_data(hash_funcs=FRAME_HASH)
+def build_treemap(sun):
+    fig = go.Figure(go.Treemap(**hierarchy(sun), branchvalues='total'))
+    fig.update_traces(uirevision='constant')
+    fig.update_layout(title='Treemap of Hydropower Capacity by Country and Facility', **layout_style)
+    return fig
 
-fig6 = px.treemap(
-    df,
-    path=['country', 'name'],
-    values='capacity_mw',
-    title='Treemap of Hydropower Capacity by Country and Facility'
-)
-fig6.update_layout(**layout_style)
-st.plotly_chart(fig6, use_container_width=True)
+@st.fragment
+def treemap_section(mtime, pl_df):
+    st.markdown("---")
+    st.subheader("6. Treemap of Hydropower Capacity")
+    st.markdown("The treemap illustrates the proportion of hydropower capacity by country and facility.")
+
+    fig6 = build_treemap(sunburst_data(mtime, pl_df))
+    st.plotly_chart(fig6, use_container_width=True, key='fig6')
+
+treemap_section(data_mtime, pl_df)